@@ -5,24 +5,56 @@ aze
 """
 
 import argparse
+import atexit
 import bz2
+import collections
 import configparser
+import datetime
 import itertools
-import json
 import logging
 import logging.handlers
+import multiprocessing
+import operator
+import os
+import re
 import sys
+import time
 
 import pdb
 
 import arrow
 import peewee
 import requests
+import requests.adapters
+from requests.packages.urllib3.util.retry import Retry
 
 from path import Path
 
-
-DATABASE = peewee.SqliteDatabase(Path(__file__).realpath().parent / "db.sqlite3")
+try:
+    import orjson as json_parser
+except ImportError:
+    import json as json_parser
+
+
+# file path is only known once the configuration is read
+DATABASE = peewee.SqliteDatabase(
+    None,
+    pragmas=[
+        # readers do not block the writer, and commits append to the log
+        ('journal_mode', 'wal'),
+        # safe under wal: commits are not synced, checkpoints are
+        ('synchronous', 'normal'),
+        # negative value is in KiB, so 64 MiB of page cache
+        ('cache_size', -65536),
+        ('temp_store', 'memory'),
+        ('mmap_size', 268435456),
+        ('busy_timeout', 5000),
+        # let the log grow to 10000 pages before a commit checkpoints it,
+        # App.run also checkpoints after each poll or file (each N in --dir)
+        ('wal_autocheckpoint', 10000)])
+
+# boolean values as written by the api
+YES_NO_BOOLEANS = {"yes": True, "no": False}
 
 
 class VmsException(Exception):
@@ -77,6 +109,7 @@ class GpsCoordinates:
         b = GpsCoordinates(48.1, 1.5)
         t = GpsCoordinates(49.1, 1.6)
     """
+    __slots__ = ('latitude', 'longitude')
 
     def __init__(self, latitude, longitude):
         try:
@@ -86,15 +119,14 @@ class GpsCoordinates:
             raise VmsException("Invalid latitude {0} or longitude {1}: {2}".format(latitude, longitude, exception))
 
     def __repr__(self):
-        return "{0}({1}, {2})".format(__class__.__name__, self.latitude, self.longitude)
+        return f"{type(self).__name__}({self.latitude}, {self.longitude})"
 
     def __lt__(self, other):
         return (self.latitude < other.latitude
             and self.longitude < other.longitude)
 
     def __iter__(self):
-        yield self.latitude
-        yield self.longitude
+        return iter((self.latitude, self.longitude))
 
     @classmethod
     def from_dict(cls, data):
@@ -122,31 +154,73 @@ class BaseModel(peewee.Model):
         """
         database = DATABASE
 
-    # @classmethod
-    # def set_database_filepath(cls, file_path):
-    #     """
-    #     aze
-    #     """
-    #     # See https://github.com/coleifer/peewee/issues/221
-    #     logging.info("Using database:", file_path)
-    #     cls._meta.database = peewee.SqliteDatabase(file_path)
-
-    # @classmethod
-    # def open_database(cls):
-    #     """
-    #     aze
-    #     """
-    #     cls._meta.database.connect()
+    @classmethod
+    def set_database_filepath(cls, file_path):
+        """
+        Points the deferred database to file_path, keeping its pragmas
+        """
+        # See https://github.com/coleifer/peewee/issues/221
+        logging.info("Using database: %s", file_path)
+        cls._meta.database.init(file_path)
+
+    @classmethod
+    def open_database(cls):
+        """
+        Opens the persistent connection, applying the pragmas
+        """
+        cls._meta.database.connect()
+
+    @classmethod
+    def optimize_database(cls):
+        """
+        Refreshes query planner statistics
+        """
+        logging.debug("Optimizing database")
+        cls._meta.database.execute_sql('PRAGMA optimize;')
+
+    @classmethod
+    def checkpoint_database(cls):
+        """
+        Copies committed pages back into the database without waiting for readers
+        """
+        cls._meta.database.execute_sql('PRAGMA wal_checkpoint(PASSIVE);')
+
+    @classmethod
+    def close_database(cls):
+        """
+        Optimizes and closes the connection
+        """
+        database = cls._meta.database
+        if database.is_closed():
+            return
+        cls.optimize_database()
+        database.close()
 
     @classmethod
     def create_tables(cls):
         """
         aze
         """
+        # a single query lists existing tables, instead of one per model
+        existing = set(cls._meta.database.get_tables())
         for subclass in cls.__subclasses__():
-            if not subclass.table_exists():
+            if subclass._meta.db_table not in existing:
                 logging.info("Creating table %s", subclass.__name__)
                 subclass.create_table()
+            else:
+                subclass.create_missing_indexes()
+
+    @classmethod
+    def create_missing_indexes(cls):
+        """
+        Creates the indexes declared in Meta which an existing table lacks
+        """
+        database = cls._meta.database
+        existing = {tuple(index.columns) for index in database.get_indexes(cls._meta.db_table)}
+        for fields, unique in cls._meta.indexes:
+            if tuple(fields) not in existing:
+                logging.info("Creating index %s on table %s", fields, cls.__name__)
+                database.create_index(cls, fields, unique)
 
 
 class ApiReachabilityStat(BaseModel):
@@ -171,38 +245,78 @@ class ApiReachabilityStat(BaseModel):
 
 class StationCommon:
     """
-    aze
+    Station models helpers, reading and writing ROW_TYPE tuples through
+    raw sql on the sqlite3 cursor, as peewee would convert every value
     """
-    def get_latest_up_to_self(self):
+    @classmethod
+    def latest_rows(cls, codes, max_moment):
         """
-        aze
+        Returns the latest stored state up to max_moment of each of codes,
+        as a dictionary of rows keyed by code
+        """
+        # one (code, moment) index seek per code: the cost follows the batch,
+        # whereas grouping MAX(moment) by code scans the whole table
+        sql = 'SELECT {1} FROM "{0}" WHERE "code" = ? AND "moment" <= ? ' \
+              'ORDER BY "moment" DESC LIMIT 1'.format(
+                  cls._meta.db_table,
+                  cls.row_columns())
+        cursor = cls._meta.database.get_cursor()
+        rows = {}
+        for code in codes:
+            row = cursor.execute(sql, (code, max_moment)).fetchone()
+            if row is not None:
+                rows[code] = cls.ROW_TYPE._make(row)
+        return rows
+
+    @classmethod
+    def row_columns(cls):
+        """
+        Returns the quoted column list matching ROW_TYPE fields
+        """
+        return ', '.join('"{0}"'.format(column) for column in cls.ROW_TYPE._fields)
+
+    @classmethod
+    def insert_rows(cls, rows):
+        """
+        Inserts rows (of ROW_TYPE) ignoring the ones which already exist
+        """
+        sql = 'INSERT OR IGNORE INTO "{0}" ({1}) VALUES ({2})'.format(
+            cls._meta.db_table,
+            cls.row_columns(),
+            ', '.join('?' * len(cls.ROW_TYPE._fields)))
+        cls._meta.database.get_cursor().executemany(sql, rows)
+
+
+class StationRowCommon:
+    """
+    Station rows helpers, for rows starting with moment and code
+    (parsed rows are tuples, lighter than models as most are not saved)
+    """
+    __slots__ = ()
+
+    @staticmethod
+    def bool_from_yes_no_str(value):
+        """
+        Converts a yes/no api value to a boolean
         """
-        cls = self.__class__
-        sub_query = cls \
-            .select(peewee.fn.MAX(cls.moment)) \
-            .where(cls.code == self.code) \
-            .where(cls.moment <= self.moment)
-        query = cls \
-            .select() \
-            .where(cls.code == self.code) \
-            .where(cls.moment == sub_query)
         try:
-            return query.get()
-        except peewee.DoesNotExist as exception:
-            logging.debug("not found")
-            return None
+            return YES_NO_BOOLEANS[value]
+        except (KeyError, TypeError):
+            raise ApiParsingException("Invalid value for boolean conversion: {0}".format(value))
 
-    def save_if_changed(self):
+    def has_changed(self, other):
         """
-        aze
+        Compare everything except moment and code
         """
-        logging.debug("Saving if changed %s", self)
-        previous = self.get_latest_up_to_self()
-        logging.debug("Latest up to self is %s", previous)
+        return self[2:] != other[2:]
 
+    def needs_saving(self, previous):
+        """
+        Tells if self differs from previous, the latest stored state up to self
+        """
         # nothing exists in database before self
         if previous is None:
-            return self.save(force_insert=True)
+            return True
 
         # this must not happend
         if self.moment < previous.moment:
@@ -210,58 +324,22 @@ class StationCommon:
 
         # check age
         if previous.moment < self.moment:
-            if self.has_changed(previous):
-                return self.save(force_insert=True)
-        else:
-            # same moment !
-            # available design choices:
-            # - do nothing
-            # - update values from previous to self
-            # current choice: do nothing
-            pass
+            return self.has_changed(previous)
 
-        return 0
+        # same moment !
+        # available design choices:
+        # - do nothing
+        # - update values from previous to self
+        # current choice: do nothing
+        return False
 
 
-class StationInfo(StationCommon, BaseModel):
+class StationInfoRow(StationRowCommon, collections.namedtuple('StationInfoRow', (
+        'moment code state name stype due_date gps_latitude gps_longitude'))):
     """
-    Holds "permanent" station information
+    Holds "permanent" station information, as parsed from the api
     """
-    moment = peewee.IntegerField()
-    state = peewee.CharField() # TODO: "Operative"/"Work in progress"/.../?
-    name = peewee.CharField()
-    stype = peewee.BooleanField()
-    code = peewee.IntegerField()
-    due_date = peewee.IntegerField(null=True)
-    gps_latitude = peewee.FloatField()
-    gps_longitude = peewee.FloatField()
-
-    class Meta:
-
-        primary_key = peewee.CompositeKey('moment', 'code')
-
-    def __repr__(self):
-        return "{0}({1}, {2}, {3}, {4}, {5}, {6}, {7}, {8})".format(
-            __class__.__name__,
-            self.moment,
-            self.state,
-            self.name,
-            self.stype,
-            self.code,
-            self.due_date,
-            self.gps_latitude,
-            self.gps_longitude)
-
-    def has_changed(self, other):
-        """
-        Compare everything except moment and code
-        """
-        return (self.state != other.state
-                or self.name != other.name
-                or self.stype != other.stype
-                or self.due_date != other.due_date
-                or self.gps_latitude != other.gps_latitude
-                or self.gps_longitude != other.gps_longitude)
+    __slots__ = ()
 
     @classmethod
     def from_dict(cls, moment, data):
@@ -280,14 +358,15 @@ class StationInfo(StationCommon, BaseModel):
         }
         """
         try:
+            gps = data['gps']
             return cls(
                 moment=moment,
-                state=data['state'],
+                state=sys.intern(data['state']),
                 name=data['name'],
-                stype=VelibMetropoleApi.bool_from_yes_no_str(data['type']),
+                stype=cls.bool_from_yes_no_str(data['type']),
                 code=int(data['code']),
-                gps_latitude=float(data['gps']['latitude']),
-                gps_longitude=float(data['gps']['longitude']),
+                gps_latitude=float(gps['latitude']),
+                gps_longitude=float(gps['longitude']),
 
                 # FIX: due_date is None seen on 2018-01-07 10:09
                 # {
@@ -308,73 +387,31 @@ class StationInfo(StationCommon, BaseModel):
             raise ApiParsingException("Cannot build station information: ({0}) {1}".format(type(exception).__name__, exception))
 
 
-class StationRecord(StationCommon, BaseModel):
+class StationRecordRow(StationRowCommon, collections.namedtuple('StationRecordRow', (
+        'moment code overflow max_bike_overflow nb_e_bike_overflow kiosk_state '
+        'density_level nb_ebike nb_free_dock nb_dock nb_bike_overflow nb_e_dock '
+        'credit_card nb_bike nb_free_e_dock overflow_activation'))):
     """
-    Holds full station information and state at a specific moment in time
+    Holds station state at a specific moment in time, as parsed from the api
     """
-    moment = peewee.IntegerField()
-    code = peewee.IntegerField()
-    overflow = peewee.BooleanField()
-    max_bike_overflow = peewee.IntegerField()
-    nb_e_bike_overflow = peewee.IntegerField()
-    kiosk_state = peewee.BooleanField()
-    density_level = peewee.IntegerField()
-    nb_ebike = peewee.IntegerField()
-    nb_free_dock = peewee.IntegerField()
-    nb_dock = peewee.IntegerField()
-    nb_bike_overflow = peewee.IntegerField()
-    nb_e_dock = peewee.IntegerField()
-    credit_card = peewee.BooleanField()
-    nb_bike = peewee.IntegerField()
-    nb_free_e_dock = peewee.IntegerField()
-    overflow_activation = peewee.BooleanField()
-
-
-    class Meta:
-
-        primary_key = peewee.CompositeKey('moment', 'code')
-
-
-    def __repr__(self):
-        return ("{0}({1}, {2}, {3}, {4}, {5}, "
-                "{6}, {7}, {8}, {9}, {10}, "
-                "{11}, {12}, {13}, {14}, {15}, {16})").format(
-                    __class__.__name__,
-                    self.moment,
-                    self.code,
-                    self.overflow,
-                    self.max_bike_overflow,
-                    self.nb_e_bike_overflow,
-                    self.kiosk_state,
-                    self.density_level,
-                    self.nb_ebike,
-                    self.nb_free_dock,
-                    self.nb_dock,
-                    self.nb_bike_overflow,
-                    self.nb_e_dock,
-                    self.credit_card,
-                    self.nb_bike,
-                    self.nb_free_e_dock,
-                    self.overflow_activation)
-
-    def has_changed(self, other):
-        """
-        Compare everything except moment and code
-        """
-        return (self.overflow != other.overflow
-                or self.max_bike_overflow != other.max_bike_overflow
-                or self.nb_e_bike_overflow != other.nb_e_bike_overflow
-                or self.kiosk_state != other.kiosk_state
-                or self.density_level != other.density_level
-                or self.nb_ebike != other.nb_ebike
-                or self.nb_free_dock != other.nb_free_dock
-                or self.nb_dock != other.nb_dock
-                or self.nb_bike_overflow != other.nb_bike_overflow
-                or self.nb_e_dock != other.nb_e_dock
-                or self.credit_card != other.credit_card
-                or self.nb_bike != other.nb_bike
-                or self.nb_free_e_dock != other.nb_free_e_dock
-                or self.overflow_activation != other.overflow_activation)
+    __slots__ = ()
+
+    # api key and conversion of every field after moment and code, in order
+    JSON_SCHEMA = (
+        ('overflow', StationRowCommon.bool_from_yes_no_str),
+        ('maxBikeOverflow', int),
+        ('nbEBikeOverflow', int),
+        ('kioskState', StationRowCommon.bool_from_yes_no_str),
+        ('densityLevel', int),
+        ('nbEbike', int),
+        ('nbFreeDock', int),
+        ('nbDock', int),
+        ('nbBikeOverflow', int),
+        ('nbEDock', int),
+        ('creditCard', StationRowCommon.bool_from_yes_no_str),
+        ('nbBike', int),
+        ('nbFreeEDock', int),
+        ('overflowActivation', StationRowCommon.bool_from_yes_no_str))
 
     @classmethod
     def from_dict(cls, moment, data):
@@ -409,41 +446,83 @@ class StationRecord(StationCommon, BaseModel):
         }
         """
         try:
-            return cls(
-                moment=moment,
-                code=int(data['station']['code']),
-                overflow=VelibMetropoleApi.bool_from_yes_no_str(data['overflow']),
-                max_bike_overflow=int(data['maxBikeOverflow']),
-                nb_e_bike_overflow=int(data['nbEBikeOverflow']),
-                kiosk_state=VelibMetropoleApi.bool_from_yes_no_str(data['kioskState']),
-                density_level=int(data['densityLevel']),
-                nb_ebike=int(data['nbEbike']),
-                nb_free_dock=int(data['nbFreeDock']),
-                nb_dock=int(data['nbDock']),
-                nb_bike_overflow=int(data['nbBikeOverflow']),
-                nb_e_dock=int(data['nbEDock']),
-                credit_card=VelibMetropoleApi.bool_from_yes_no_str(data['creditCard']),
-                nb_bike=int(data['nbBike']),
-                nb_free_e_dock=int(data['nbFreeEDock']),
-                overflow_activation=VelibMetropoleApi.bool_from_yes_no_str(data['overflowActivation']))
+            return cls(moment, int(data['station']['code']),
+                       *[convert(data[key]) for key, convert in cls.JSON_SCHEMA])
         except (TypeError, KeyError, ValueError) as exception:
             logging.warning("Input station record: %s", data)
             raise ApiParsingException("Cannot build station record: ({0}) {1}".format(type(exception).__name__, exception))
 
 
-class StationSample:
+class StationInfo(StationCommon, BaseModel):
     """
-    aze
+    Holds "permanent" station information
     """
-    def __init__(self, info, record):
-        self._info = info
-        self._record = record
+    moment = peewee.IntegerField()
+    state = peewee.CharField() # TODO: "Operative"/"Work in progress"/.../?
+    name = peewee.CharField()
+    stype = peewee.BooleanField()
+    code = peewee.IntegerField()
+    due_date = peewee.IntegerField(null=True)
+    gps_latitude = peewee.FloatField()
+    gps_longitude = peewee.FloatField()
+
+    ROW_TYPE = StationInfoRow
+
+    class Meta:
+
+        primary_key = peewee.CompositeKey('moment', 'code')
+        # latest state per station lookups
+        indexes = ((('code', 'moment'), False),)
 
     def __repr__(self):
-        return ("{0}({1}, {2})").format(
-                    __class__.__name__,
-                    self._info,
-                    self._record)
+        return (f"{type(self).__name__}({self.moment}, {self.state}, {self.name}, {self.stype}, "
+                f"{self.code}, {self.due_date}, {self.gps_latitude}, {self.gps_longitude})")
+
+
+class StationRecord(StationCommon, BaseModel):
+    """
+    Holds full station information and state at a specific moment in time
+    """
+    moment = peewee.IntegerField()
+    code = peewee.IntegerField()
+    overflow = peewee.BooleanField()
+    max_bike_overflow = peewee.IntegerField()
+    nb_e_bike_overflow = peewee.IntegerField()
+    kiosk_state = peewee.BooleanField()
+    density_level = peewee.IntegerField()
+    nb_ebike = peewee.IntegerField()
+    nb_free_dock = peewee.IntegerField()
+    nb_dock = peewee.IntegerField()
+    nb_bike_overflow = peewee.IntegerField()
+    nb_e_dock = peewee.IntegerField()
+    credit_card = peewee.BooleanField()
+    nb_bike = peewee.IntegerField()
+    nb_free_e_dock = peewee.IntegerField()
+    overflow_activation = peewee.BooleanField()
+
+    ROW_TYPE = StationRecordRow
+
+
+    class Meta:
+
+        primary_key = peewee.CompositeKey('moment', 'code')
+        # latest state per station lookups
+        indexes = ((('code', 'moment'), False),)
+
+
+    def __repr__(self):
+        return (f"{type(self).__name__}({self.moment}, {self.code}, {self.overflow}, "
+                f"{self.max_bike_overflow}, {self.nb_e_bike_overflow}, {self.kiosk_state}, "
+                f"{self.density_level}, {self.nb_ebike}, {self.nb_free_dock}, {self.nb_dock}, "
+                f"{self.nb_bike_overflow}, {self.nb_e_dock}, {self.credit_card}, {self.nb_bike}, "
+                f"{self.nb_free_e_dock}, {self.overflow_activation})")
+
+
+class StationSample(collections.namedtuple('StationSample', 'info record')):
+    """
+    Pairs the info and record rows of a station, as a plain tuple
+    """
+    __slots__ = ()
 
     @classmethod
     def from_dict(cls, moment, data):
@@ -456,17 +535,8 @@ class StationSample:
             ...
         }
         """
-        return cls(StationInfo.from_dict(moment, data['station']),
-                   StationRecord.from_dict(moment, data))
-
-    def save_all_if_changed(self):
-        """
-        aze
-        """
-        n_saved = 0
-        n_saved += StationCommon.save_if_changed(self._info)
-        n_saved += StationCommon.save_if_changed(self._record)
-        return n_saved
+        return cls(StationInfoRow.from_dict(moment, data['station']),
+                   StationRecordRow.from_dict(moment, data))
 
     @staticmethod
     def remove_duplicate_code(iterable):
@@ -536,11 +606,9 @@ class StationSample:
         - if many remain, raise an exception
         """
         # group by code
-        sample_bins = {}
-        for index, sample in enumerate(iterable):
-            group = sample_bins.get(sample._info.code, [])
-            group.append(sample)
-            sample_bins[sample._info.code] = group
+        sample_bins = collections.defaultdict(list)
+        for sample in iterable:
+            sample_bins[sample.info.code].append(sample)
         # find duplicates
         for code, samples in sample_bins.items():
             # skip if no duplicates
@@ -548,14 +616,14 @@ class StationSample:
                 continue
             logging.warning("Duplicates samples found in input: %s", samples)
             # remove non-operative
-            samples = [sample for sample in samples if sample._info.state == "Operative"]
+            samples = [sample for sample in samples if sample.info.state == "Operative"]
             # do not go further if there are still duplicates
             if len(samples) > 1:
                 raise VmsException("Could not auto-fix duplicate samples found, remains: {0}".format(samples))
             # store filtered result back into original group
             sample_bins[code] = samples
         # flatten sub-lists
-        return (sample for sample in samples for samples in sample_bins.values())
+        return itertools.chain.from_iterable(sample_bins.values())
 
 
 class VelibMetropoleApi:
@@ -563,18 +631,6 @@ class VelibMetropoleApi:
     Allows access to velib-metropole.fr data feed
     """
 
-    @staticmethod
-    def bool_from_yes_no_str(value):
-        """
-        aze
-        """
-        if value == "yes":
-            return True
-        elif value == "no":
-            return False
-        else:
-            raise ApiParsingException("Invalid value for boolean conversion: {0}".format(value))
-
     URL_TEMPLATE = (
         "https://www.velib-metropole.fr/webapi/map/details?"
         "gpsTopLatitude={0}&"
@@ -586,47 +642,65 @@ class VelibMetropoleApi:
     DEFAULT_TOP_COORDINATES = (49.1, 2.7)
     DEFAULT_BOTTOM_COORDINATES = (48.6, 1.9)
 
-    def __init__(self, top_coordinates=None, bottom_coordinates=None, zoom_level=15):
+    USER_AGENT = "velib-metropole-stats"
+
+    def __init__(self, top_coordinates=None, bottom_coordinates=None, zoom_level=15, session=None):
         self._top_coordinates = top_coordinates or GpsCoordinates(*self.DEFAULT_TOP_COORDINATES)
         self._bottom_coordinates = bottom_coordinates or GpsCoordinates(*self.DEFAULT_BOTTOM_COORDINATES)
         if not self._bottom_coordinates < self._top_coordinates:
             raise VmsException("Constraint violated: {0} < {1}".format(self._bottom_coordinates, self._top_coordinates))
         self._zoom_level = zoom_level
+        # parameters never change afterwards
+        self._url = self.URL_TEMPLATE.format(
+            *self._top_coordinates,
+            *self._bottom_coordinates,
+            self._zoom_level)
+        # reuse the connection across requests, and retry transient errors
+        # (the last response is kept so that error codes are still reported,
+        # and read timeouts are not retried so that they still raise Timeout)
+        # unless the caller provides its own session, which it then closes
+        self._owns_session = session is None
+        if session is None:
+            session = requests.Session()
+            session.mount("https://", requests.adapters.HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=4,
+                max_retries=Retry(total=3, read=False, backoff_factor=0.3, status_forcelist=[502, 503, 504], raise_on_status=False)))
+            # sent on every request, along with the default gzip encoding
+            session.headers.update({'User-Agent': self.USER_AGENT})
+        self._session = session
 
     def __str__(self):
         return self.to_url()
 
     def __repr__(self):
-        return "{0}({1}, {2}, {3})".format(
-            __class__.__name__,
-            self._top_coordinates,
-            self._bottom_coordinates,
-            self._zoom_level)
+        return f"{type(self).__name__}({self._top_coordinates}, {self._bottom_coordinates}, {self._zoom_level})"
+
+    def close(self):
+        """
+        Releases the pooled connections of our own session
+        """
+        if self._owns_session:
+            self._session.close()
 
     def to_url(self):
         """
         Get url with parameters filled with member values
         """
-        return self.URL_TEMPLATE.format(
-            *self._top_coordinates,
-            *self._bottom_coordinates,
-            self._zoom_level)
+        return self._url
 
     def get_json(self):
         """
         Fetches API data using parametrized URL
-        Parses JSON input
-        Returns a list of StationSamples
+        Returns the raw JSON body as bytes, left undecoded for the parser
         """
         try:
             # get content
-            request = requests.get(self.to_url(), timeout=30)
+            request = self._session.get(self._url, timeout=30)
             # handle non-ok return codes
             request.raise_for_status()
-            # convert to text
-            text = request.text
             # return our precious data
-            return text
+            return request.content
 
         except requests.exceptions.Timeout as exception:
             raise ApiNetworkTimeout(exception)
@@ -641,12 +715,16 @@ class VelibMetropoleApi:
 class Configuration:
 
     def __init__(self, config_file):
-        self._configuration = configparser.ConfigParser()
-        self._configuration.read(Path(config_file).expand())
+        parser = configparser.ConfigParser()
+        parser.read(Path(config_file).expand())
+        # values are read once, interpolated, then looked up by (section, name)
+        self._configuration = {(section, name): value
+                               for section in parser.sections()
+                               for name, value in parser.items(section)}
 
     def get(self, section, name):
         try:
-            return self._configuration[section][name]
+            return self._configuration[section, name]
         except KeyError:
             raise VmsException("Undefined option '{0}' in configuration section '{1}'".format(name, section))
 
@@ -658,8 +736,15 @@ class App:
 
     FILENAME_TIMESTAMP_PATTERN = 'YYYY-MM-DD_HH-mm-ss_ZZZ'
 
+    # what arrow would build from the pattern above, compiled only once
+    FILENAME_TIMESTAMP_REGEX = re.compile(r'(\d{4})-(\d{2})-(\d{2})_(\d{2})-(\d{2})-(\d{2})_(\w[\w+\-/]+)')
+
+    _filename_timezones = {}
+
     ALLOWED_LOG_TIME_FREQ = ['S', 'M', 'H', 'D', *['W%i' % i for i in range(7)], 'midnight']
 
+    OPTIMIZE_EVERY_N_BATCHES = 100
+
     def __init__(self, args):
 
         # read configuration file
@@ -692,50 +777,104 @@ class App:
             raise VmsException('Invalid log level: {0}'.format(level))
         console_handler.setLevel(numeric_level)
 
+        # fork file readers before the database connection is opened,
+        # as sqlite connections must not be carried across fork()
+        self._jobs = self._args.jobs or os.cpu_count() or 1
+        self._pool = multiprocessing.Pool(self._jobs) if self._args.dir else None
+
         # setup database target
-        # BaseModel.set_database_filepath(os.path.expanduser(self._configuration.get('database', 'file_path'))) # TODO: fix
-        # BaseModel.open_database() # TODO: fix
+        BaseModel.set_database_filepath(Path(self._configuration.get('database', 'file_path')).expand())
+        BaseModel.open_database()
+        atexit.register(BaseModel.close_database)
         BaseModel.create_tables()
 
         # instanciate data
         self._api = VelibMetropoleApi()
+        atexit.register(self._api.close)
+        # api success moment, saved within the same commit as its data
+        self._pending_api_stat = None
 
-    def get_from_file(self, file_path):
+    @classmethod
+    def get_from_file(cls, file_path):
         """
-        aze
+        Reads file_path, which callers have already expanded
         """
-        full_path = Path(file_path).expand()
-        logging.info("Processing file %s", full_path)
-        file_name = full_path.name
-        try:
-            moment = arrow.get(file_name, self.FILENAME_TIMESTAMP_PATTERN)
-        except arrow.parser.ParserError as exception:
-            raise VmsException("Could find pattern {0} at start of filename {1}".format(self.FILENAME_TIMESTAMP_PATTERN, file_name))
+        moment = cls.timestamp_from_file_name(os.path.basename(file_path))
         try:
-            with bz2.open(full_path, 'rt') as file_obj:
+            with bz2.open(file_path, 'rb') as file_obj:
                 data = file_obj.read()
         except OSError as exception:
-            raise VmsException("Could not bunzip2 {0}: {1}".format(full_path, exception))
+            raise VmsException("Could not bunzip2 {0}: {1}".format(file_path, exception))
         # return infos to caller
         return (moment, data)
 
+    @classmethod
+    def timestamp_from_file_name(cls, file_name):
+        """
+        Returns the timestamp found in file_name, parsed without arrow
+        as this is called for every file in --dir mode
+        """
+        match = cls.FILENAME_TIMESTAMP_REGEX.search(file_name)
+        if match is None:
+            raise VmsException("Could find pattern {0} at start of filename {1}".format(cls.FILENAME_TIMESTAMP_PATTERN, file_name))
+        *fields, timezone_name = match.groups()
+        # only a handful of timezone names ever show up, resolve them once
+        timezone = cls._filename_timezones.get(timezone_name)
+        if timezone is None:
+            try:
+                timezone = arrow.parser.TzinfoParser.parse(timezone_name)
+            except arrow.parser.ParserError as exception:
+                raise VmsException("Could not parse timezone of filename {0}: {1}".format(file_name, exception))
+            cls._filename_timezones[timezone_name] = timezone
+        try:
+            return int(datetime.datetime(*map(int, fields), tzinfo=timezone).timestamp())
+        except ValueError as exception:
+            raise VmsException("Invalid timestamp in filename {0}: {1}".format(file_name, exception))
+
+    def get_from_files(self, file_paths):
+        """
+        Decompresses files in worker processes, reading a few files ahead,
+        and yields (file_path, moment, data) in the original order, as
+        processing must stay chronological
+        """
+        file_paths = iter(file_paths)
+        with self._pool as pool:
+            pending = collections.deque()
+            read_ahead = 2 * self._jobs
+            for file_path in itertools.islice(file_paths, read_ahead):
+                pending.append((file_path, pool.apply_async(self.get_from_file, (file_path,))))
+            while pending:
+                file_path, result = pending.popleft()
+                moment, data = result.get()
+                for next_path in itertools.islice(file_paths, 1):
+                    pending.append((next_path, pool.apply_async(self.get_from_file, (next_path,))))
+                yield (file_path, moment, data)
+
     def get_from_api(self):
         """
         aze
         """
-        moment = arrow.utcnow()
+        moment = int(time.time())
         try:
             data = self._api.get_json()
         except ApiNetworkException as exception:
             # save stats for errors
-            ApiReachabilityStat.save_api_stat(moment.timestamp, False, str(exception))
+            ApiReachabilityStat.save_api_stat(moment, False, str(exception))
             raise
         else:
-            # save stats for successes
-            ApiReachabilityStat.save_api_stat(moment.timestamp, True)
+            # stats for successes are saved by do_work, or save_pending_api_stat
+            self._pending_api_stat = moment
         # return infos to caller
         return (moment, data)
 
+    def save_pending_api_stat(self):
+        """
+        Saves the stat of the latest api success, if not already done
+        """
+        if self._pending_api_stat is not None:
+            ApiReachabilityStat.save_api_stat(self._pending_api_stat, True)
+            self._pending_api_stat = None
+
     def do_work(self, moment, data):
         """
         aze
@@ -746,8 +885,8 @@ class App:
 
         # parse json
         try:
-            json_data = json.loads(data)
-        except json.JSONDecodeError as exception:
+            json_data = json_parser.loads(data)
+        except ValueError as exception:
             logging.debug("Invalid JSON: %s", data)
             raise ApiParsingException("Could not parse json data: {0}".format(exception))
 
@@ -779,15 +918,27 @@ class App:
         logging.info("%s records in incoming data", len(json_data))
 
         # build objects
-        station_records = (StationSample.from_dict(moment.timestamp, entry) for entry in json_data)
-        station_records = StationSample.remove_duplicate_code(station_records)
+        station_records = (StationSample.from_dict(moment, entry) for entry in json_data)
+        station_records = list(StationSample.remove_duplicate_code(station_records))
 
         # process
-        new_records_count = 0
+        info_rows, record_rows = [], []
         with DATABASE.atomic() as transaction:
-            for entry in station_records:
-                new_records_count += entry.save_all_if_changed()
-        logging.info("%s updates detected", new_records_count)
+            if self._pending_api_stat is not None:
+                ApiReachabilityStat.save_api_stat(self._pending_api_stat, True)
+            codes = [info.code for info, _ in station_records]
+            latest_infos = StationInfo.latest_rows(codes, moment)
+            latest_records = StationRecord.latest_rows(codes, moment)
+            for info, record in station_records:
+                if info.needs_saving(latest_infos.get(info.code)):
+                    info_rows.append(info)
+                if record.needs_saving(latest_records.get(record.code)):
+                    record_rows.append(record)
+            StationInfo.insert_rows(info_rows)
+            StationRecord.insert_rows(record_rows)
+        # committed along with the data
+        self._pending_api_stat = None
+        logging.info("%s updates detected", len(info_rows) + len(record_rows))
 
     def run(self):
         """
@@ -796,23 +947,56 @@ class App:
         if self._args.dir:
             logging.info("Searching directory %s", self._args.dir)
             try:
-                files = Path(self._args.dir).files()
+                with os.scandir(self._args.dir) as entries:
+                    file_paths = [entry.path
+                                  for entry in sorted(entries, key=operator.attrgetter('name'))
+                                  if entry.is_file()]
             except (NotADirectoryError, FileNotFoundError) as exception:
                 raise VmsException("Could not list files: {0}".format(exception))
-            for file_path in sorted(files):
-                moment, data = self.get_from_file(file_path)
+            for index, (file_path, moment, data) in enumerate(self.get_from_files(file_paths), 1):
+                # logged here, as workers read files ahead of their processing
+                logging.info("Processing file %s", file_path)
                 try:
                     self.do_work(moment, data)
                 except ApiException as exception:
                     if not self._args.skip_file_on_error:
                         raise
                     logging.warning("Error while processing, but continuing as requested {0}: {1}".format(file_path, exception))
+                # keep statistics fresh and the log short during long imports
+                if index % self.OPTIMIZE_EVERY_N_BATCHES == 0:
+                    BaseModel.optimize_database()
+                    BaseModel.checkpoint_database()
         elif self._args.file:
-            moment, data = self.get_from_file(self._args.file)
+            file_path = Path(self._args.file).expand()
+            logging.info("Processing file %s", file_path)
+            moment, data = self.get_from_file(file_path)
             self.do_work(moment, data)
+            BaseModel.checkpoint_database()
         else:
             moment, data = self.get_from_api()
-            self.do_work(moment, data)
+            try:
+                self.do_work(moment, data)
+            finally:
+                # when processing failed before saving it
+                self.save_pending_api_stat()
+            BaseModel.checkpoint_database()
+
+
+    def loop(self, interval):
+        """
+        Polls the api every interval seconds, forever, reusing the open
+        database connection (and its warm caches) and the http session
+        """
+        for index in itertools.count(1):
+            start = time.monotonic()
+            try:
+                self.run()
+            except VmsException as exception:
+                # payload or data errors only affect this poll, as with cron
+                logging.warning("Error while polling, retrying at next interval: (%s) %s", type(exception).__name__, exception)
+            if index % self.OPTIMIZE_EVERY_N_BATCHES == 0:
+                BaseModel.optimize_database()
+            time.sleep(max(0, interval - (time.monotonic() - start)))
 
 
 def main():
@@ -826,10 +1010,21 @@ def main():
         parser.add_argument('-l', '--log-level', choices=['debug', 'info', 'warning', 'error', 'critical'])
         parser.add_argument('-f', '--file')
         parser.add_argument('-d', '--dir')
+        parser.add_argument('-j', '--jobs', type=int)
         parser.add_argument('--skip-file-on-error', default=False, action='store_true')
+        parser.add_argument('--loop', type=int, metavar='SECONDS')
         args = parser.parse_args()
+        if args.loop is not None and (args.file or args.dir):
+            parser.error("--loop only applies to api polling")
+        if args.loop is not None and args.loop < 1:
+            parser.error("--loop must be at least 1 second")
+        if args.jobs is not None and args.jobs < 1:
+            parser.error("--jobs must be at least 1")
         app = App(args)
-        app.run()
+        if args.loop is not None:
+            app.loop(args.loop)
+        else:
+            app.run()
         sys.exit(0)
 
     except KeyboardInterrupt: